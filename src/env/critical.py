@@ -1,6 +1,7 @@
 import numpy as np
-from numpy.linalg import inv
+from numba import njit, prange
 from scipy import interpolate
+from scipy.spatial import cKDTree
 from src.env.utils.physical_constant import MU, pi
 from typing import Optional, Tuple, List, Union
 from warnings import warn
@@ -8,6 +9,318 @@ from warnings import warn
 CRITERIA = 1e-6
 MAX_COUNT = 128
 
+# spline fits are expensive (knot generation + LAPACK) while the (R,Z) grid is
+# fixed over a simulation, so cache fitted splines keyed on grid extent and the
+# psi buffer identity
+_spline_cache = {}
+_SPLINE_CACHE_SIZE = 8
+
+
+def _get_spline(R : np.ndarray, Z : np.ndarray, psi : np.ndarray):
+    key = (psi.shape, R[0,0], R[-1,0], Z[0,0], Z[0,-1], psi.ctypes.data)
+    hit = _spline_cache.get(key)
+
+    if hit is not None:
+        # the entry snapshots psi as fitted, so a hit is trusted on content
+        # only : identity proves nothing, because the solvers rewrite psi
+        # buffers in place and the address key would still match
+        cached_psi, spline = hit
+        if np.array_equal(cached_psi, psi):
+            return spline
+
+    if len(_spline_cache) >= _SPLINE_CACHE_SIZE:
+        _spline_cache.clear()
+
+    spline = interpolate.RectBivariateSpline(R[:,0], Z[0,:], psi)
+    _spline_cache[key] = (psi.copy(), spline)
+
+    return spline
+
+
+# normalised-psi splines get their own cache : the normalisation allocates a
+# fresh O(nx*ny) array every call, which would always miss the spline cache
+_psinorm_cache = {}
+
+
+def _get_psinorm_spline(eq, psi : np.ndarray, psi_axis : float, psi_bndry : float):
+    key = (psi.shape, psi.ctypes.data, psi_axis, psi_bndry)
+    hit = _psinorm_cache.get(key)
+
+    if hit is not None:
+        # same rule as _get_spline : a hit is trusted on content only, since
+        # an address match says nothing about whether the buffer still holds
+        # the field the spline was fitted from
+        cached_psi, spline = hit
+        if np.array_equal(cached_psi, psi):
+            return spline
+
+    if len(_psinorm_cache) >= _SPLINE_CACHE_SIZE:
+        _psinorm_cache.clear()
+
+    psinorm = (psi - psi_axis) / (psi_bndry - psi_axis)
+    spline = _get_spline(eq.R, eq.Z, psinorm)
+    _psinorm_cache[key] = (psi.copy(), spline)
+
+    return spline
+
+
+@njit(cache = True)
+def _find_interval(t : np.ndarray, k : int, x : float):
+    # locate knot interval l with t[l] <= x < t[l+1], clamped to the valid span
+    n = t.shape[0] - k - 1
+
+    if x <= t[k]:
+        return k
+    if x >= t[n]:
+        return n - 1
+
+    lo = k
+    hi = n - 1
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if t[mid] <= x:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _bicubic_table(f):
+    '''Exact piecewise power-basis coefficients of a fitted RectBivariateSpline
+    Returns (xb, yb, A) where xb, yb are the cell breakpoints and
+    A[i,j] holds the 4x4 coefficient matrix (descending powers) of the
+    bicubic polynomial on cell (i,j), so evaluation is a cell lookup plus
+    Horner instead of a B-spline basis recursion.
+    The table is cached on the spline object, which _get_spline already
+    caches per grid.
+    '''
+    if hasattr(f, '_bicubic'):
+        return f._bicubic
+
+    tx, ty, c = f.tck
+    kx, ky = f.degrees
+    c = c.reshape(len(tx) - kx - 1, len(ty) - ky - 1)
+
+    xb = np.unique(tx)
+    yb = np.unique(ty)
+    nxc = len(xb) - 1
+    nyc = len(yb) - 1
+
+    # convert along x : one 1D pp-conversion per y coefficient column
+    Dx = np.empty((kx + 1, nxc, c.shape[1]))
+    for b in range(c.shape[1]):
+        pp = interpolate.PPoly.from_spline((tx, c[:,b], kx))
+        # from_spline keeps zero-width intervals at the clamped ends
+        real = np.diff(pp.x) > 0
+        Dx[:, :, b] = pp.c[:, real]
+
+    # convert along y : each x-cell / x-power row is a 1D spline in y
+    A = np.empty((nxc, nyc, kx + 1, ky + 1))
+    for i in range(nxc):
+        for p in range(kx + 1):
+            pp = interpolate.PPoly.from_spline((ty, Dx[p, i, :], ky))
+            real = np.diff(pp.x) > 0
+            A[i, :, p, :] = pp.c[:, real].T
+
+    f._bicubic = (xb, yb, A)
+    return f._bicubic
+
+
+@njit(cache = True)
+def _eval_bicubic_partials(xb : np.ndarray, yb : np.ndarray, A : np.ndarray, x : float, y : float):
+    # evaluate f, fx, fy, fxx, fyy, fxy at (x,y) from the per-cell
+    # power-basis table : Horner in the local offsets (u,v)
+    i = _find_interval(xb, 0, x)
+    j = _find_interval(yb, 0, y)
+
+    u = x - xb[i]
+    v = y - yb[j]
+
+    C = A[i, j]
+    kx = C.shape[0] - 1
+    ky = C.shape[1] - 1
+
+    # reduce along y first : value and v-derivatives per u-power row
+    s0 = np.empty(kx + 1)
+    s1 = np.empty(kx + 1)
+    s2 = np.empty(kx + 1)
+
+    for p in range(kx + 1):
+        val = C[p, 0]
+        for q in range(1, ky + 1):
+            val = val * v + C[p, q]
+        s0[p] = val
+
+        d1 = C[p, 0] * ky
+        for q in range(1, ky):
+            d1 = d1 * v + C[p, q] * (ky - q)
+        s1[p] = d1
+
+        d2 = C[p, 0] * ky * (ky - 1)
+        for q in range(1, ky - 1):
+            d2 = d2 * v + C[p, q] * (ky - q) * (ky - q - 1)
+        s2[p] = d2
+
+    # then along x
+    f = s0[0]
+    fy = s1[0]
+    fyy = s2[0]
+    for p in range(1, kx + 1):
+        f = f * u + s0[p]
+        fy = fy * u + s1[p]
+        fyy = fyy * u + s2[p]
+
+    fx = s0[0] * kx
+    fxy = s1[0] * kx
+    for p in range(1, kx):
+        fx = fx * u + s0[p] * (kx - p)
+        fxy = fxy * u + s1[p] * (kx - p)
+
+    fxx = s0[0] * kx * (kx - 1)
+    for p in range(1, kx - 1):
+        fxx = fxx * u + s0[p] * (kx - p) * (kx - p - 1)
+
+    return f, fx, fy, fxx, fyy, fxy
+
+
+@njit(cache = True)
+def _eval_bicubic(xb : np.ndarray, yb : np.ndarray, A : np.ndarray, x : float, y : float):
+    # value-only bicubic evaluation from the per-cell power-basis table
+    i = _find_interval(xb, 0, x)
+    j = _find_interval(yb, 0, y)
+
+    u = x - xb[i]
+    v = y - yb[j]
+
+    C = A[i, j]
+    kx = C.shape[0] - 1
+    ky = C.shape[1] - 1
+
+    f = 0.0
+    for p in range(kx + 1):
+        val = C[p, 0]
+        for q in range(1, ky + 1):
+            val = val * v + C[p, q]
+        f = f * u + val
+
+    return f
+
+
+@njit(cache = True, parallel = True)
+def _find_surfaces(xb : np.ndarray, yb : np.ndarray, A : np.ndarray, r0 : float, z0 : float, r1 : np.ndarray, z1 : np.ndarray, psi_range : np.ndarray, n : int):
+    # locate every psi surface along every theta ray, one prange worker per
+    # flux surface ; each ray is marched until its first sample above psival
+    # and the crossing is interpolated linearly between the two samples
+    n_psi = psi_range.shape[0]
+    n_theta = r1.shape[0]
+
+    r = np.empty((n_psi, n_theta))
+    z = np.empty((n_psi, n_theta))
+
+    for i in prange(n_psi):
+        psival = psi_range[i]
+
+        for j in range(n_theta):
+            dr = r1[j] - r0
+            dz = z1[j] - z0
+
+            idx = 0
+            p_idx = 0.0
+            p_prev = 0.0
+
+            prev = _eval_bicubic(xb, yb, A, r0, z0)
+
+            if prev <= psival:
+                for k in range(1, n):
+                    t = k / (n - 1.0)
+                    p = _eval_bicubic(xb, yb, A, r0 + dr * t, z0 + dz * t)
+                    if p > psival:
+                        idx = k
+                        p_idx = p
+                        p_prev = prev
+                        break
+                    prev = p
+
+            if idx == 0:
+                # either the very first sample is above psival or no sample
+                # is : mirror argmax semantics with the wrap to sample n-1
+                p_idx = _eval_bicubic(xb, yb, A, r0, z0)
+                p_prev = _eval_bicubic(xb, yb, A, r0 + dr, z0 + dz)
+
+            frac = (p_idx - psival) / (p_idx - p_prev)
+
+            t_idx = idx / (n - 1.0)
+            t_prev = (idx - 1) / (n - 1.0) if idx > 0 else 1.0
+
+            r[i, j] = (1.0 - frac) * (r0 + dr * t_idx) + frac * (r0 + dr * t_prev)
+            z[i, j] = (1.0 - frac) * (z0 + dz * t_idx) + frac * (z0 + dz * t_prev)
+
+    return r, z
+
+
+@njit(cache = True, parallel = True)
+def _q_integrate(r : np.ndarray, z : np.ndarray, fpol : np.ndarray, Br : np.ndarray, Bz : np.ndarray):
+    # per-surface line integral of fpol / (R^2 B_theta) dl with centered
+    # differences computed in registers : no (n_psi, n_theta) temporaries
+    n_psi, n_theta = r.shape
+    q = np.empty(n_psi)
+
+    for i in prange(n_psi):
+        acc = 0.0
+        for j in range(n_theta):
+            jp = (j + 1) % n_theta
+            jm = (j - 1) % n_theta
+
+            dr = r[i, jm] - r[i, jp]
+            dz = z[i, jm] - z[i, jp]
+            dl = np.sqrt(dr * dr + dz * dz)
+
+            Bthe = np.sqrt(Br[i, j] ** 2 + Bz[i, j] ** 2)
+
+            acc += fpol[i] / (r[i, j] ** 2 * Bthe) * dl
+
+        q[i] = acc / (2 * pi)
+
+    return q
+
+
+@njit(cache = True)
+def _newton_root(xb : np.ndarray, yb : np.ndarray, A : np.ndarray, R0 : float, Z0 : float, radius_sq : float, criteria : float, max_count : int):
+    # Newton iteration toward Br = Bz = 0, entirely in compiled code
+    R1 = R0
+    Z1 = Z0
+
+    count = 0
+
+    while True:
+        p, px, py, pxx, pyy, pxy = _eval_bicubic_partials(xb, yb, A, R1, Z1)
+
+        Br = -py / R1
+        Bz = px / R1
+
+        if Br ** 2 + Bz ** 2 < criteria:
+            return R1, Z1, p, True
+
+        # J : Jacobian matrix
+        # J : [[dBr/dR, dBr/dZ],[dBz/dR, dBz/dZ]]
+        J00 = -Br / R1 - pxy / R1
+        J01 = -pyy / R1
+        J10 = -Bz / R1 + pxx / R1
+        J11 = pxy / R1
+
+        det = J00 * J11 - J01 * J10
+
+        R1 = R1 - (J11 * Br - J01 * Bz) / det
+        Z1 = Z1 - (-J10 * Br + J00 * Bz) / det
+
+        count += 1
+
+        if ((R1 - R0) ** 2 + (Z1 - Z0) ** 2 > radius_sq) or (count > max_count):
+            # discard this point
+            return R1, Z1, p, False
+
 
 def find_critical(R : np.ndarray, Z : np.ndarray, psi : np.ndarray, discard_xpoints : bool = True):
     '''Find critical points of psi
@@ -22,124 +335,155 @@ def find_critical(R : np.ndarray, Z : np.ndarray, psi : np.ndarray, discard_xpoi
     
     '''
 
-    f = interpolate.RectBivariateSpline(R[:,0],Z[0,:], psi)
+    f = _get_spline(R, Z, psi)
 
     Bp2 = (f(R,Z,dx = 1, grid = False)**2 + f(R,Z,dy = 1, grid = False) ** 2) / R ** 2
 
+    # the scan only compares Bp2 values, so half the bandwidth is enough ;
+    # psi itself stays float64 for the spline fit and Newton convergence
+    Bp2 = Bp2.astype(np.float32, copy = False)
+
     dR = R[1,0] - R[0,0]
     dZ = Z[0,1] - Z[0,0]
 
     radius_sq = 9 * (dR ** 2 + dZ ** 2)
 
     # find local minimum
-    J = np.zeros([2,2])
-
     xpoint = []
     opoint = []
 
     nx, ny = Bp2.shape
 
-    for i in range(2,nx-2):
-        for j in range(2,ny-2):
-            if (
-                (Bp2[i, j] < Bp2[i + 1, j + 1])
-                and (Bp2[i, j] < Bp2[i + 1, j])
-                and (Bp2[i, j] < Bp2[i + 1, j - 1])
-                and (Bp2[i, j] < Bp2[i - 1, j + 1])
-                and (Bp2[i, j] < Bp2[i - 1, j])
-                and (Bp2[i, j] < Bp2[i - 1, j - 1])
-                and (Bp2[i, j] < Bp2[i, j + 1])
-                and (Bp2[i, j] < Bp2[i, j - 1])
-            ):
-
-                # Found local minimum
-                R0 = R[i,j]
-                Z0 = Z[i,j]
-
-                R1 = R0
-                Z1 = Z0
+    # local minimum scan : compare each interior point with its 8 neighbours
+    # using shifted array views, all comparisons run in C instead of a python double loop
+    c = Bp2[2:-2, 2:-2]
+
+    minimum_mask = (
+        (c < Bp2[3:-1, 3:-1])
+        & (c < Bp2[3:-1, 2:-2])
+        & (c < Bp2[3:-1, 1:-3])
+        & (c < Bp2[1:-3, 3:-1])
+        & (c < Bp2[1:-3, 2:-2])
+        & (c < Bp2[1:-3, 1:-3])
+        & (c < Bp2[2:-2, 3:-1])
+        & (c < Bp2[2:-2, 1:-3])
+    )
 
-                count = 0
+    candidates = np.argwhere(minimum_mask) + 2
+
+    # prune false candidates before committing to Newton : drop minima whose
+    # psi Hessian discriminant is degenerate (neither a clear saddle nor a
+    # clear extremum) or whose Bp2 is nowhere near zero
+    if candidates.shape[0] > 0:
+        ip = candidates[:,0]
+        jp = candidates[:,1]
+
+        d2dr2_c = (psi[ip+2, jp] - 2.0 * psi[ip,jp] + psi[ip-2, jp]) / (2.0 * dR) ** 2
+        d2dz2_c = (psi[ip, jp+2] - 2.0 * psi[ip,jp] + psi[ip, jp-2]) / (2.0 * dZ) ** 2
+        d2drdz_c = (
+            (psi[ip+2,jp+2] - psi[ip+2,jp-2]) / (4.0 * dZ) -
+            (psi[ip-2,jp+2] - psi[ip-2,jp-2]) / (4.0 * dZ)
+        ) / (4.0 * dR)
+        D_cand = d2dr2_c * d2dz2_c - d2drdz_c ** 2
+
+        keep = np.abs(D_cand) > 1e-8 * np.amax(np.abs(D_cand))
+
+        # the grid-node Bp2 of a true null scales with the node offset squared
+        # times the local psi Hessian, not with the domain-wide field, so the
+        # cut is per candidate : a null within one cell of its node satisfies
+        # Bp2 <~ (dR^2 + dZ^2) * |H|^2 / R^2 ; skip the cut rather than empty
+        # the list
+        bp2_c = Bp2[ip, jp].astype(np.float64)
+        H2_c = d2dr2_c ** 2 + 2.0 * d2drdz_c ** 2 + d2dz2_c ** 2
+        keep_bp2 = bp2_c < (dR ** 2 + dZ ** 2) * H2_c / R[ip, jp] ** 2
+        if np.any(keep & keep_bp2):
+            keep &= keep_bp2
+
+        candidates = candidates[keep]
+
+    # per-cell bicubic coefficient table for the jitted Newton kernel
+    xb, yb, A = _bicubic_table(f)
+
+    for i, j in candidates:
+
+        # Found local minimum
+        R0 = R[i,j]
+        Z0 = Z[i,j]
+
+        R1, Z1, psi_crit, converged = _newton_root(
+            xb, yb, A, R0, Z0, radius_sq, CRITERIA, MAX_COUNT
+        )
 
-                while True:
-                    Br = -f(R1,Z1, dy = 1, grid = False) / R1
-                    Bz = f(R1,Z1, dx = 1, grid = False) / R1
+        if not converged:
+            # discard this point
+            continue
 
-                    if Br ** 2 + Bz ** 2 < CRITERIA:
+        d2dr2 = (psi[i+2, j] - 2.0 * psi[i,j] + psi[i-2, j]) / (2.0 * dR) ** 2
+        d2dz2 = (psi[i, j+2] - 2.0 * psi[i,j] + psi[i, j-2]) / (2.0 * dZ) ** 2
 
-                        dR = R[1,0] - R[0,0]
-                        dZ = Z[0,1] - Z[0,0]
+        d2drdz = (
+            (psi[i+2,j+2] - psi[i+2,j-2]) / (4.0 * dZ) -
+            (psi[i-2,j+2] - psi[i-2,j-2]) / (4.0 * dZ)
+        ) / (4.0 * dR)
+        D = d2dr2 * d2dz2 - d2drdz ** 2
 
-                        d2dr2 = (psi[i+2, j] - 2.0 * psi[i,j] + psi[i-2, j]) / (2.0 * dR) ** 2
-                        d2dz2 = (psi[i, j+2] - 2.0 * psi[i,j] + psi[i, j-2]) / (2.0 * dZ) ** 2
+        if D < 0:
+            # Found x-point
+            xpoint.append((R1, Z1, psi_crit))
+        else:
+            opoint.append((R1, Z1, psi_crit))
 
-                        d2drdz = (
-                            (psi[i+2,j+2] - psi[i+2,j-2]) / (4.0 * dZ) -
-                            (psi[i-2,j+2] - psi[i-2,j-2]) / (4.0 * dZ)
-                        ) / (4.0 * dR)
-                        D = d2dr2 * d2dz2 - d2drdz ** 2
 
-                        if D < 0:
-                            # Found x-point
-                            xpoint.append((R1,Z1,f(R1,Z1)[0][0]))
-                        else:
-                            opoint.append((R1,Z1,f(R1,Z1)[0][0]))
+    # SoA layout : keep the candidate collections as contiguous (N,3) arrays
+    # of (R, Z, psi) so dedup, distance and sorting run on unboxed float64
+    xarr = np.asarray(xpoint, dtype = np.float64).reshape(-1,3)
+    oarr = np.asarray(opoint, dtype = np.float64).reshape(-1,3)
 
-                        break
+    # Remove duplicates
+    def remove_dup(points):
+        if points.shape[0] < 2:
+            return points
 
-                    # J : Jacobian matrix
-                    # J : [[dBr/dR, dBr/dZ],[dBz/dR, dBz/dZ]]
-                    J[0,0] = -Br / R1 - f(R1,Z1,dy=1,dx=1)[0][0] / R1
-                    J[0,1] = -f(R1,Z1,dy=2)[0][0] / R1
-                    J[1,0] = -Bz / R1 + f(R1,Z1,dx = 2) / R1
-                    J[1,1] = f(R1,Z1,dx = 1, dy = 1)[0][0] / R1
+        pairs = cKDTree(points[:,0:2]).query_pairs(r = np.sqrt(1e-5), output_type = 'ndarray')
 
-                    d = np.dot(inv(J), [Br,Bz])
+        # union-find over duplicate pairs, keeping the first point of each cluster
+        parent = np.arange(points.shape[0])
 
-                    R1 = R1 - d[0]
-                    Z1 = Z1 - d[1]
+        def find(a):
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
 
-                    count += 1
+        for a, b in pairs:
+            ra, rb = find(a), find(b)
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
 
-                    if((R1-R0) ** 2 + (Z1-Z0)**2 > radius_sq) or (count > MAX_COUNT):
-                        # discard this point
-                        break
+        keep = np.array([find(n) == n for n in range(points.shape[0])])
 
-    
-    # Remove duplicates
-    def remove_dup(points):
-        result = []
-        for n,p in enumerate(points):
-            dup = False
-            for p2 in result:
-                if(p[0] - p2[0]) ** 2 + (p[1] - p2[1]) ** 2 < 1e-5:
-                    dup = True
-                    break
-                    
-            if not dup:
-                result.append(p)
-        return result
+        return points[keep]
 
-    xpoint = remove_dup(xpoint)
-    opoint = remove_dup(opoint)
+    xarr = remove_dup(xarr)
+    oarr = remove_dup(oarr)
 
-    if len(opoint) == 0:
+    if oarr.shape[0] == 0:
         print("Warning : no 0-point found")
-        return opoint, xpoint
+        return [], [tuple(p) for p in xarr]
 
     # Find primary 0point by sorting by distance from middle of domain
     Rmid = 0.5 * (R[-1,0] - R[0,0])
     Zmid = 0.5 * (Z[0,-1] - Z[0,0])
 
-    opoint.sort(key = lambda x : (x[0] - Rmid) ** 2 + (x[1] - Zmid) ** 2)
+    oarr = oarr[np.argsort((oarr[:,0] - Rmid) ** 2 + (oarr[:,1] - Zmid) ** 2, kind = 'stable')]
 
     if discard_xpoints:
-        Ro,Zo,Po = opoint[0]
+        Ro, Zo, Po = oarr[0]
 
-        xpt_keep = []
+        keep = np.zeros(xarr.shape[0], dtype = bool)
 
-        for xpt in xpoint:
-            Rx,Zx,Px = xpt
+        for n in range(xarr.shape[0]):
+            Rx, Zx, Px = xarr[n]
 
             rline = np.linspace(Ro,Rx,num=64)
             zline = np.linspace(Zo,Zx,num=64)
@@ -148,31 +492,75 @@ def find_critical(R : np.ndarray, Z : np.ndarray, psi : np.ndarray, discard_xpoi
 
             if Px < Po:
                 pline *= -1.0 # psi 값 가운데 o-point > x-point일 경우 reverse하여 x-point가 더 크도록 한다
-            
+
             maxp = np.amax(pline)
-            
+
             if (maxp - pline[-1]) / (maxp - pline[0]) > 0.001:
                 # more than 0.1% drop in psi from maximum to x-point
                 continue
-        
+
             ind = np.argmin(pline) # should be at o-point
 
             if(rline[ind] - Ro) ** 2 + (zline[ind] - Zo) ** 2 > 1e-4:
                 # too far, discard this point
                 continue
-        
-            xpt_keep.append(xpt)
 
-        if len(xpt_keep) >= 1:
-            xpoint = xpt_keep
+            keep[n] = True
+
+        if np.any(keep):
+            xarr = xarr[keep]
 
     # Sort x-points by distance to primary o-point in psi space
-    psi_axis = opoint[0][2]
-    xpoint.sort(key = lambda x : (x[2] - psi_axis) ** 2)
+    psi_axis = oarr[0,2]
+    xarr = xarr[np.argsort((xarr[:,2] - psi_axis) ** 2, kind = 'stable')]
+
+    # tuple conversion only at the return boundary for API compatibility
+    opoint = [tuple(p) for p in oarr]
+    xpoint = [tuple(p) for p in xarr]
 
     return opoint, xpoint
 
 
+@njit(cache = True)
+def _flood_fill(psin : np.ndarray, mask : np.ndarray, rind : int, zind : int, nx : int, ny : int):
+    # scanline flood fill from the magnetic axis, marking core cells with 1
+    # mask : int8, 0 = unvisited, 1 = core, 2 = blocked (x-point neighbourhood)
+    stack = np.empty((4 * nx * ny, 2), np.int32)
+    stack[0, 0] = rind
+    stack[0, 1] = zind
+    sp = 1
+
+    while sp > 0:  # Whilst there are any points left
+        sp -= 1  # Remove from list
+        i = stack[sp, 0]
+        j = stack[sp, 1]
+
+        # Check the point to the left (i,j-1)
+        if (j > 0) and (psin[i, j - 1] < 1.0) and (mask[i, j - 1] == 0):
+            stack[sp, 0] = i
+            stack[sp, 1] = j - 1
+            sp += 1
+
+        # Scan along a row to the right
+        while True:
+            mask[i, j] = 1  # Mark as in the core
+
+            if (i < nx - 1) and (psin[i + 1, j] < 1.0) and (mask[i + 1, j] == 0):
+                stack[sp, 0] = i + 1
+                stack[sp, 1] = j
+                sp += 1
+            if (i > 0) and (psin[i - 1, j] < 1.0) and (mask[i - 1, j] == 0):
+                stack[sp, 0] = i - 1
+                stack[sp, 1] = j
+                sp += 1
+
+            if j == ny - 1:  # End of the row
+                break
+            if (psin[i, j + 1] >= 1.0) or (mask[i, j + 1] != 0):
+                break  # Finished this row
+            j += 1  # Move to next point along
+
+
 def core_mask(R,Z,psi,opoint, xpoint = [], psi_bndry = None):
     '''Mark the parts of the domain which are in the core
     Arguments:
@@ -186,7 +574,7 @@ def core_mask(R,Z,psi,opoint, xpoint = [], psi_bndry = None):
     2D array [nx,ny] which is 1 inside the core, 0 outside
     '''
 
-    mask = np.zeros(psi.shape)
+    mask = np.zeros(psi.shape, np.int8)
     nx, ny = psi.shape
 
     # Start and end points
@@ -194,8 +582,14 @@ def core_mask(R,Z,psi,opoint, xpoint = [], psi_bndry = None):
     if psi_bndry is None:
         _, _, psi_bndry = xpoint[0]
 
-    # Normalise psi
-    psin = (psi - psi_axis) / (psi_bndry - psi_axis)
+    # Normalise psi : float32, the flood fill only compares against 1.0
+    psin = ((psi - psi_axis) / (psi_bndry - psi_axis)).astype(np.float32)
+
+    # grid spacing for O(1) nearest-index arithmetic on the regular grid
+    dR = R[1,0] - R[0,0]
+    dZ = Z[0,1] - Z[0,0]
+    Rmin = R[0,0]
+    Zmin = Z[0,0]
 
     # Need some care near X-points to avoid flood filling through saddle point
     # Here we first set the x-points regions to a value, to block the flood fill
@@ -204,50 +598,26 @@ def core_mask(R,Z,psi,opoint, xpoint = [], psi_bndry = None):
     xpt_inds = []
     for rx, zx, _ in xpoint:
         # Find nearest index
-        ix = np.argmin(abs(R[:, 0] - rx))
-        jx = np.argmin(abs(Z[0, :] - zx))
+        ix = min(max(int(round((rx - Rmin) / dR)), 0), nx - 1)
+        jx = min(max(int(round((zx - Zmin) / dZ)), 0), ny - 1)
         xpt_inds.append((ix, jx))
-        # Fill this point and all around with '2'
-        for i in np.clip([ix - 1, ix, ix + 1], 0, nx - 1):
-            for j in np.clip([jx - 1, jx, jx + 1], 0, ny - 1):
-                mask[i, j] = 2
+        # Fill this point and all around with '2' in one sliced assignment
+        i0, i1 = max(ix - 1, 0), min(ix + 2, nx)
+        j0, j1 = max(jx - 1, 0), min(jx + 2, ny)
+        mask[i0:i1, j0:j1] = 2
 
     # Find nearest index to start
-    rind = np.argmin(abs(R[:, 0] - Ro))
-    zind = np.argmin(abs(Z[0, :] - Zo))
-
-    stack = [(rind, zind)]  # List of points to inspect in future
+    rind = min(max(int(round((Ro - Rmin) / dR)), 0), nx - 1)
+    zind = min(max(int(round((Zo - Zmin) / dZ)), 0), ny - 1)
 
-    while stack:  # Whilst there are any points left
-        i, j = stack.pop()  # Remove from list
-
-        # Check the point to the left (i,j-1)
-        if (j > 0) and (psin[i, j - 1] < 1.0) and (mask[i, j - 1] < 0.5):
-            stack.append((i, j - 1))
-
-        # Scan along a row to the right
-        while True:
-            mask[i, j] = 1  # Mark as in the core
-
-            if (i < nx - 1) and (psin[i + 1, j] < 1.0) and (mask[i + 1, j] < 0.5):
-                stack.append((i + 1, j))
-            if (i > 0) and (psin[i - 1, j] < 1.0) and (mask[i - 1, j] < 0.5):
-                stack.append((i - 1, j))
-
-            if j == ny - 1:  # End of the row
-                break
-            if (psin[i, j + 1] >= 1.0) or (mask[i, j + 1] > 0.5):
-                break  # Finished this row
-            j += 1  # Move to next point along
+    _flood_fill(psin, mask, rind, zind, nx, ny)
 
     # Now return to X-point locations
     for ix, jx in xpt_inds:
-        for i in np.clip([ix - 1, ix, ix + 1], 0, nx - 1):
-            for j in np.clip([jx - 1, jx, jx + 1], 0, ny - 1):
-                if psin[i, j] < 1.0:
-                    mask[i, j] = 1
-                else:
-                    mask[i, j] = 0
+        i0, i1 = max(ix - 1, 0), min(ix + 2, nx)
+        j0, j1 = max(jx - 1, 0), min(jx + 2, ny)
+        core = psin[i0:i1, j0:j1] < 1.0
+        mask[i0:i1, j0:j1] = core.astype(mask.dtype)
 
     return mask
 
@@ -267,32 +637,124 @@ def find_psisurface(eq, psifunc, r0 : float, z0 : float, r1 : float, z1 : float,
         r1 = r0 + (r1 - r0) * abs((zclip - z0) / (z1 - z0))
         z1 = zclip
     
-    r = np.linspace(r0,r1,n)
-    z = np.linspace(z0,z1,n)
+    if hasattr(psival, "__len__"):
+        r = np.linspace(r0,r1,n)
+        z = np.linspace(z0,z1,n)
 
-    if axis is not None:
-        axis.plot(r,z)
-    
-    pnorm = psifunc(r,z,grid = False)
+        if axis is not None:
+            axis.plot(r,z)
 
-    if hasattr(psival, "__len__"):
-        pass
+        pnorm = psifunc(r,z,grid = False)
 
     else:
-        idx = np.argmax(pnorm > psival)
+        # bracket the crossing with a coarse scan, then refine with secant
+        # iterations : order-of-magnitude fewer spline evaluations than
+        # sampling the full n-point line
+        t_c = np.linspace(0.0, 1.0, 8)
+        r_c = r0 + (r1 - r0) * t_c
+        z_c = z0 + (z1 - z0) * t_c
+
+        if axis is not None:
+            axis.plot(r_c, z_c)
+
+        p_c = psifunc(r_c, z_c, grid = False)
+
+        # pnorm is usually monotone along a ray from the o-point, but not
+        # near a secondary lobe (private-flux region below an x-point), where
+        # binary search would bracket a far crossing instead of the first ;
+        # only use it when the coarse scan really is sorted
+        if np.all(np.diff(p_c) >= 0):
+            idx = int(np.searchsorted(p_c, psival, side = 'right'))
+            if idx >= p_c.shape[0]:
+                # no sample above psival : match argmax's fallback index
+                idx = 0
+        else:
+            idx = int((p_c > psival).argmax())
+
+        if idx == 0:
+            # no coarse sample above psival : the crossing region is narrower
+            # than the coarse spacing (ray grazing the x-point) or absent, so
+            # fall back to the full dense scan with its exact semantics
+            rd = np.linspace(r0,r1,n)
+            zd = np.linspace(z0,z1,n)
+
+            pd = psifunc(rd,zd,grid = False)
+
+            i = np.argmax(pd > psival)
+
+            f = (pd[i] - psival) / (pd[i] - pd[i - 1])
+
+            t_new = ((1.0 - f) * i + f * (i - 1)) / (n - 1.0)
+        else:
+            t_hi, p_hi = t_c[idx], p_c[idx]
+            t_lo, p_lo = t_c[idx - 1], p_c[idx - 1]
+
+            t_new = t_hi
+
+            for _ in range(10):
+                if p_hi == p_lo:
+                    break
 
-        # changed 1.0 to psival in f
-        # f gradient to psival surface
-        f = (pnorm[idx] - psival) / (pnorm[idx] - pnorm[idx - 1])
+                t_new = t_lo + (psival - p_lo) / (p_hi - p_lo) * (t_hi - t_lo)
 
-        r = (1.0 - f) * r[idx] + f * r[idx - 1]
-        z = (1.0 - f) * z[idx] + f * z[idx - 1]
+                p_new = float(psifunc(r0 + (r1 - r0) * t_new, z0 + (z1 - z0) * t_new, grid = False))
+
+                if abs(p_new - psival) < 1e-8:
+                    break
+
+                if p_new > psival:
+                    t_hi, p_hi = t_new, p_new
+                else:
+                    t_lo, p_lo = t_new, p_new
+
+        r = r0 + (r1 - r0) * t_new
+        z = z0 + (z1 - z0) * t_new
 
     if axis is not None:
         axis.plot(r,z,"bo")
-    
+
     return r,z
 
+def _clip_rays(eq, r0 : float, z0 : float, r1 : np.ndarray, z1 : np.ndarray):
+    # vectorized counterpart of find_psisurface's endpoint clipping :
+    # clip (r1,z1) to be inside domain, keeping the ray direction unchanged
+    dr = r1 - r0
+    move_r = np.abs(dr) > 1e-6
+    rclip = np.clip(r1, eq.Rmin, eq.Rmax)
+    scale = np.ones_like(dr)
+    scale[move_r] = np.abs((rclip[move_r] - r0) / dr[move_r])
+    z1 = np.where(move_r, z0 + (z1 - z0) * scale, z1)
+    r1 = np.where(move_r, rclip, r1)
+
+    dz = z1 - z0
+    move_z = np.abs(z1 - r0) > 1e-6
+    move_z &= np.abs(dz) > 1e-12
+    zclip = np.clip(z1, eq.Zmin, eq.Zmax)
+    scale = np.ones_like(dz)
+    scale[move_z] = np.abs((zclip[move_z] - z0) / dz[move_z])
+    r1 = np.where(move_z, r0 + (r1 - r0) * scale, r1)
+    z1 = np.where(move_z, zclip, z1)
+
+    return r1, z1
+
+
+def _trace_rays(eq, psifunc, r0 : float, z0 : float, r1 : np.ndarray, z1 : np.ndarray, n : int = 128):
+    # batched counterpart of find_psisurface's ray setup : clip every ray
+    # endpoint to the domain, sample n points per ray and evaluate the psi
+    # spline over all rays in a single call
+    # r1, z1 : (n_rays,) ray endpoints
+    # returns rmat, zmat, pmat of shape (n_rays, n)
+    r1, z1 = _clip_rays(eq, r0, z0, r1, z1)
+
+    t = np.linspace(0.0, 1.0, n)
+    rmat = r0 + (r1 - r0)[:, None] * t[None, :]
+    zmat = z0 + (z1 - z0)[:, None] * t[None, :]
+
+    pmat = psifunc(rmat.ravel(), zmat.ravel(), grid = False).reshape(rmat.shape)
+
+    return rmat, zmat, pmat
+
+
 def find_separatrix(eq, opoint = None, xpoint = None, n_theta : int = 128, psi = None, axis = None, psival = 1.0):
     # opoint : (R,Z,psi)
     # xpoint : (R,Z,psi)
@@ -304,8 +766,7 @@ def find_separatrix(eq, opoint = None, xpoint = None, n_theta : int = 128, psi =
     if (opoint is None) or (xpoint is None):
         opoint, xpoint = find_critical(eq.R, eq.Z, psi)
     
-    psinorm = (psi - opoint[0][2]) / (xpoint[0][2] - opoint[0][2])
-    psifunc = interpolate.RectBivariateSpline(eq.R[:,0], eq.Z[0,:], psinorm)
+    psifunc = _get_psinorm_spline(eq, psi, opoint[0][2], xpoint[0][2])
 
     r0, z0 = opoint[0][0:2]
 
@@ -323,21 +784,42 @@ def find_separatrix(eq, opoint = None, xpoint = None, n_theta : int = 128, psi =
         warn("Theta grid too close to x-point, shifting by two-step")
         theta_grid += dtheta / 2
     
-    isoflux = []
-
-    for theta in theta_grid:
-        r,z = find_psisurface(
-            eq,
-            psifunc,
-            r0,
-            z0,
-            r0 + 10.0 * np.sin(theta),
-            z0 + 10.0 * np.cos(theta),
-            psival = psival,
-            axis = axis
-        )
+    # trace all theta directions at once : one spline call for every ray
+    rmat, zmat, pmat = _trace_rays(
+        eq,
+        psifunc,
+        r0,
+        z0,
+        r0 + 10.0 * np.sin(theta_grid),
+        z0 + 10.0 * np.cos(theta_grid),
+    )
+
+    if axis is not None:
+        axis.plot(rmat.T, zmat.T)
 
-        isoflux.append((r,z,xpoint[0][0], xpoint[0][1]))
+    # first sample past psival on each ray, then interpolate back linearly
+    idx = (pmat > psival).argmax(axis = 1)
+
+    p_idx = np.take_along_axis(pmat, idx[:, None], 1)[:, 0]
+    p_prev = np.take_along_axis(pmat, (idx - 1)[:, None], 1)[:, 0]
+
+    frac = (p_idx - psival) / (p_idx - p_prev)
+
+    r_sep = (1.0 - frac) * np.take_along_axis(rmat, idx[:, None], 1)[:, 0] \
+        + frac * np.take_along_axis(rmat, (idx - 1)[:, None], 1)[:, 0]
+    z_sep = (1.0 - frac) * np.take_along_axis(zmat, idx[:, None], 1)[:, 0] \
+        + frac * np.take_along_axis(zmat, (idx - 1)[:, None], 1)[:, 0]
+
+    if axis is not None:
+        axis.plot(r_sep, z_sep, "bo")
+
+    # contiguous (n_theta, 4) rows of (R, Z, Rx, Zx) ; row iteration still
+    # unpacks like the old list of tuples
+    isoflux = np.empty((len(r_sep), 4))
+    isoflux[:,0] = r_sep
+    isoflux[:,1] = z_sep
+    isoflux[:,2] = xpoint[0][0]
+    isoflux[:,3] = xpoint[0][1]
 
     return isoflux
 
@@ -362,17 +844,19 @@ def find_safety(eq, psi_norm : Union[None, np.ndarray, np.array] = None, n_psi :
     
     if (xpoint is None) or (len(xpoint) == 0):
         return ValueError("No x-point from q-saftey: no separatrix")
-    else:
-        psi_norm = (psi - opoint[0][2]) / (xpoint[0][2] - opoint[0][2])
-    
-    psi_func = interpolate.RectBivariateSpline(eq.R[:,0], eq.Z[0,:], psi_norm)
 
-    r0, z0 = opoint[0][2]
+    # unpack the primary o-point once : (R, Z, psi_axis)
+    opoint0 = opoint[0]
+    xpoint0 = xpoint[0]
+
+    r0, z0, psi_axis_val = opoint0
+
+    psi_func = _get_psinorm_spline(eq, psi, psi_axis_val, xpoint0[2])
 
     theta_grid = np.linspace(0, 2 * pi, n_theta, endpoint = False)
     dtheta = theta_grid[1] - theta_grid[0]
 
-    xpoint_theta = np.arctan2(xpoint[0][0] - r0, xpoint[0][1] - z0)
+    xpoint_theta = np.arctan2(xpoint0[0] - r0, xpoint0[1] - z0)
     xpoint_theta = xpoint_theta * (xpoint_theta >= 0) + (xpoint_theta + 2 * pi) * (
         xpoint_theta < 0
     )
@@ -394,43 +878,30 @@ def find_safety(eq, psi_norm : Union[None, np.ndarray, np.array] = None, n_psi :
             n_psi = 1
             psi_range = [psi_norm]
     
-    #psi_surf : 3D matrix with n_psi, n_theta, 2(r,z totally 2 dimension)
-    psi_surf = np.zeros([n_psi, n_theta, 2])
-
-    # calculate flux surface positions
-    for i in range(n_psi):
-        psi_n = psi_range[i]
-        for j in range(n_theta):
-            theta = theta_grid[j]
-
-            r,z = find_psisurface(
-                eq,
-                psi_func,
-                r0,
-                z0,
-                r0 + 8.0 * np.sin(theta),
-                z0 + 8.0 + np.cos(theta),
-                psival = psi_n,
-                axis = axis
-            )
-
-            psi_surf[i,j,:] = [r,z]
-
-    r = psi_surf[:,:,0] # n_psi, n_theta
-    z = psi_surf[:,:,1] # n_psi, n_theta
+    # calculate flux surface positions : the rays are shared by every psi
+    # surface, so clip them once and let one prange worker per surface march
+    # its crossings from the precomputed bicubic table
+    psi_range = np.asarray(psi_range, dtype = float)
+
+    r1, z1 = _clip_rays(
+        eq,
+        r0,
+        z0,
+        r0 + 8.0 * np.sin(theta_grid),
+        z0 + 8.0 * np.cos(theta_grid),
+    )
 
-    fpol = eq.fpol(psi_range[:]).reshape(n_psi,1)
-    Br = eq.Br(r,z)
-    Bz = eq.Bz(r,z)
-    Bthe = np.sqrt(Br ** 2 + Bz ** 2)
+    xb, yb, A = _bicubic_table(psi_func)
 
-    dr_di = (np.roll(r,1,axis = 1) - np.roll(r,-1,axis = 1))
-    dz_di = (np.roll(z,1,axis = 1) - np.roll(z,-1,axis = 1))
+    r, z = _find_surfaces(xb, yb, A, r0, z0, r1, z1, psi_range, 128) # n_psi, n_theta
 
-    dl = np.sqrt(dr_di ** 2 + dz_di ** 2)
+    if axis is not None:
+        axis.plot(r, z, "bo")
 
-    qint = fpol / (r**2 * Bthe)
+    fpol = np.asarray(eq.fpol(psi_range[:]), dtype = float).reshape(n_psi)
+    Br = np.ascontiguousarray(eq.Br(r,z))
+    Bz = np.ascontiguousarray(eq.Bz(r,z))
 
-    q = np.sum(qint * dl, axis = 1) / 2 / pi
+    q = _q_integrate(r, z, fpol, Br, Bz)
 
     return q
\ No newline at end of file